@@ -0,0 +1,49 @@
+import io
+
+from PIL import Image, ImageOps
+
+# ---------------------------------------------------------
+# IMAGE PREPROCESSING (runs in a worker process)
+# ---------------------------------------------------------
+# Alag module taaki pool workers sirf Pillow import karein, poora app
+# (FastAPI, Gemini SDK, Redis) nahi.
+
+IMAGE_MAX_DIM = 1568
+IMAGE_JPEG_QUALITY = 85
+
+
+def preprocess_image(data: bytes) -> bytes:
+    img = Image.open(io.BytesIO(data))
+    # EXIF rotation apply karo; re-encode me baaki EXIF drop ho jata hai
+    img = ImageOps.exif_transpose(img)
+
+    # Resize se pehle RGB banao: transparent background ko white pe paste
+    # karo (warna black ho jata hai), aur palette images NEAREST se shrink
+    # hoti hain jisse anti-aliased text bigadta hai.
+    if img.mode in ("RGBA", "LA", "P", "PA"):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        img = background
+    elif img.mode != "RGB":
+        img = img.convert("RGB")
+
+    img.thumbnail((IMAGE_MAX_DIM, IMAGE_MAX_DIM))
+
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    return out.getvalue()
+
+
+def _make_warmup_png() -> bytes:
+    out = io.BytesIO()
+    Image.new("RGB", (8, 8), (255, 255, 255)).save(out, format="PNG")
+    return out.getvalue()
+
+
+_WARMUP_PNG = _make_warmup_png()
+
+
+def warm_up_worker() -> None:
+    # Pool warmup: worker process start + JPEG encoder load, ek chhoti image pe
+    preprocess_image(_WARMUP_PNG)
@@ -1,11 +1,34 @@
+import asyncio
+import hashlib
+import logging
+import multiprocessing
 import os
-from typing import Literal
-
-from fastapi import FastAPI, UploadFile, File
+import queue
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Annotated, Literal, get_args
+
+from cachetools import TTLCache
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, ConfigDict, StringConstraints
 from dotenv import load_dotenv
+from google.api_core.exceptions import ResourceExhausted
 import google.generativeai as genai
+import orjson
+import redis.asyncio as redis
+from redis.asyncio.retry import Retry
+from redis.backoff import NoBackoff
+import uvicorn
+from PIL import UnidentifiedImageError
+
+from image_preprocess import preprocess_image, warm_up_worker
 
 # ---------------------------------------------------------
 # LOAD ENV + CONFIG
@@ -17,12 +40,108 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not GEMINI_API_KEY:
     raise RuntimeError("GEMINI_API_KEY not set in .env")
 
-genai.configure(api_key=GEMINI_API_KEY)
-
 # Gemini 2.0 Flash
-model = genai.GenerativeModel("gemini-2.0-flash")
+GEMINI_MODEL = "gemini-2.0-flash"
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+
+# Limiter, in-flight dedup aur image pool per uvicorn worker hain;
+# sirf response cache (REDIS_URL) workers ke beech share hota hai.
+GEMINI_MAX_INFLIGHT = int(os.getenv("GEMINI_MAX_INFLIGHT", "32"))
+GEMINI_QUEUE_LIMIT = int(os.getenv("GEMINI_QUEUE_LIMIT", "64"))
+GEMINI_RETRY_AFTER_SECONDS = 5
+
+# Gemini reachable na ho to bhi startup atakna nahi chahiye
+WARMUP_TIMEOUT_SECONDS = 10
+
+# ---------------------------------------------------------
+# LOGGING (QueueHandler -> background QueueListener)
+# ---------------------------------------------------------
+
+request_id_var: ContextVar[str] = ContextVar("request_id", default="-")
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.req_id = request_id_var.get()
+        return True
+
+
+# Request path sirf queue me daalta hai; stdout write listener thread karta hai
+log_queue: queue.Queue = queue.Queue(-1)
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(
+    logging.Formatter("%(asctime)s %(levelname)s [%(req_id)s] %(name)s: %(message)s")
+)
+log_listener = QueueListener(log_queue, _log_stream)
+
+_log_queue_handler = QueueHandler(log_queue)
+_log_queue_handler.addFilter(RequestIdFilter())
+
+# Sirf app ka logger; root / third-party logging ko nahi chhedte
+logger = logging.getLogger("queryx")
+logger.addHandler(_log_queue_handler)
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    log_listener.start()
+
+    # Client + models startup pe, event loop ke andar banao (import pe nahi)
+    genai.configure(api_key=GEMINI_API_KEY)
+    app.state.models = build_models()
+
+    # Pehli request se pehle hi gRPC channel + TLS handshake ready kar do.
+    # count_tokens free hai, aur same async client/channel reuse hota hai.
+    try:
+        warm_model = app.state.models[("basic", "detailed", "hinglish")]
+        await asyncio.wait_for(
+            warm_model.count_tokens_async("ping"), WARMUP_TIMEOUT_SECONDS
+        )
+    except Exception:
+        logger.exception("Gemini warmup failed")
+
+    # Image resize/re-encode CPU-heavy hai, event loop se bahar rakho.
+    # Yahan tak gRPC channel + log thread khul chuke hain, aur gRPC
+    # fork-safe nahi hai, isliye is process ko fork mat karo. Windows pe
+    # forkserver nahi hota, wahan spawn.
+    start_method = (
+        "forkserver"
+        if "forkserver" in multiprocessing.get_all_start_methods()
+        else "spawn"
+    )
+    mp_context = multiprocessing.get_context(start_method)
+    if start_method == "forkserver":
+        # Forkserver image_preprocess pehle se load karke rakhe, har child nahi
+        mp_context.set_forkserver_preload(["__main__", "image_preprocess"])
+    app.state.image_pool = ProcessPoolExecutor(
+        max_workers=IMAGE_WORKERS, mp_context=mp_context
+    )
+
+    # Pool lazy start hota hai; warmup na karo to pehla /ask-image process
+    # spawn + imports ka kharcha uthata hai
+    try:
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *(
+                loop.run_in_executor(app.state.image_pool, warm_up_worker)
+                for _ in range(IMAGE_WORKERS)
+            )
+        )
+    except Exception:
+        logger.exception("Image pool warmup failed")
 
-app = FastAPI()
+    yield
+
+    app.state.image_pool.shutdown(wait=False, cancel_futures=True)
+    if redis_client is not None:
+        await redis_client.aclose()
+    log_listener.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # 🔴 YAHAN PE GALTI THI – ab sahi:
 app.add_middleware(
@@ -31,8 +150,38 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Browser clients ko correlation ke liye X-Request-ID padhne do
+    expose_headers=["X-Request-ID"],
 )
 
+
+class RequestIdMiddleware:
+    # Plain ASGI middleware: BaseHTTPMiddleware har request (aur har SSE
+    # chunk) pe task group + memory stream ka overhead daalta hai
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        req_id = uuid.uuid4().hex
+        request_id_var.set(req_id)
+        header = (b"x-request-id", req_id.encode())
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), header]
+            await send(message)
+
+        await self.app(scope, receive, send_with_request_id)
+
+
+app.add_middleware(RequestIdMiddleware)
+
+
 # ---------------------------------------------------------
 # TYPES
 # ---------------------------------------------------------
@@ -42,8 +191,13 @@ Style = Literal["detailed", "short"]
 Language = Literal["english", "hinglish"]
 
 
+Question = Annotated[str, StringConstraints(min_length=1, max_length=4000)]
+
+
 class AskTextRequest(BaseModel):
-    question: str
+    model_config = ConfigDict(str_strip_whitespace=True, extra="forbid", frozen=True)
+
+    question: Question
     level: Level = "basic"
     style: Style = "detailed"
     language: Language = "hinglish"
@@ -125,22 +279,244 @@ def build_system_prompt(level: str, style: str, language: str) -> str:
     )
 
 
-def make_markdown_prompt(system_prompt: str, question: str) -> str:
-    return (
-        system_prompt
-        + "\n\nQuestion:\n"
-        + question
-        + "\n\nAnswer format instructions (follow strictly):\n"
-        + "- Use markdown paragraphs + bullet / numbered lists.\n"
-        + "- All maths strictly in LaTeX.\n"
-        + "- Inline examples: $F = ma$, $T = 2\\pi\\sqrt{L/g}$.\n"
-        + "- Block examples:\n"
-        + "    $$ W = \\int_{x_1}^{x_2} F(x) \\, dx $$\n"
-        + "    $$ a(t) = \\frac{dv}{dt}, \\quad v(t) = \\frac{dx}{dt} $$\n"
-        + "- Do NOT output triple backticks.\n"
-        "- Do NOT output JSON.\n\n"
-        "Now give the final answer:\n"
+# Sirf 2 x 2 x 2 = 8 combinations hain, to sab ek baar import pe hi bana lo
+SYSTEM_PROMPTS = {
+    (level, style, language): build_system_prompt(level, style, language)
+    for level in get_args(Level)
+    for style in get_args(Style)
+    for language in get_args(Language)
+}
+
+
+# Har combination ka alag model, system prompt `system_instruction` me.
+# Isse har request ka prefix byte-identical rehta hai aur Gemini ka
+# prompt-prefix cache hit ho sakta hai.
+def build_models() -> dict:
+    return {
+        key: genai.GenerativeModel(GEMINI_MODEL, system_instruction=system_prompt)
+        for key, system_prompt in SYSTEM_PROMPTS.items()
+    }
+
+
+_MD_SUFFIX = (
+    "\n\nAnswer format instructions (follow strictly):\n"
+    "- Use markdown paragraphs + bullet / numbered lists.\n"
+    "- All maths strictly in LaTeX.\n"
+    "- Inline examples: $F = ma$, $T = 2\\pi\\sqrt{L/g}$.\n"
+    "- Block examples:\n"
+    "    $$ W = \\int_{x_1}^{x_2} F(x) \\, dx $$\n"
+    "    $$ a(t) = \\frac{dv}{dt}, \\quad v(t) = \\frac{dx}{dt} $$\n"
+    "- Do NOT output triple backticks.\n"
+    "- Do NOT output JSON.\n\n"
+    "Now give the final answer:\n"
+)
+
+
+def make_markdown_prompt(question: str) -> str:
+    return f"Question:\n{question}{_MD_SUFFIX}"
+
+
+# ---------------------------------------------------------
+# IMAGE PREPROCESSING (worker side lives in image_preprocess.py)
+# ---------------------------------------------------------
+
+
+async def prepare_image_part(
+    pool: ProcessPoolExecutor, data: bytes, content_type: str | None
+) -> dict:
+    original = {"mime_type": content_type or "image/jpeg", "data": data}
+    loop = asyncio.get_running_loop()
+
+    try:
+        jpeg_bytes = await loop.run_in_executor(pool, preprocess_image, data)
+    except UnidentifiedImageError:
+        # HEIC, PDF waghera Pillow nahi padh pata; Gemini ko original hi bhej do
+        logger.warning(
+            "Pillow could not decode %s upload, sending original bytes", content_type
+        )
+        return original
+    except Exception:
+        logger.exception("Image preprocessing failed, sending original bytes")
+        return original
+
+    return {"mime_type": "image/jpeg", "data": jpeg_bytes}
+
+
+# ---------------------------------------------------------
+# RESPONSE CACHE (in-process TTL + optional shared Redis tier)
+# ---------------------------------------------------------
+
+CACHE_TTL_SECONDS = 24 * 60 * 60
+CACHE_PREFIX = b"queryx:answer:"
+
+answer_cache: TTLCache = TTLCache(maxsize=10_000, ttl=CACHE_TTL_SECONDS)
+
+# REDIS_URL set ho to saare uvicorn workers cache share karte hain
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Redis down ho to bhi cache miss jaldi ho: chhota timeout, koi retry nahi,
+# aur ek failure ke baad kuch der Redis skip karo
+REDIS_TIMEOUT_SECONDS = 0.2
+REDIS_BACKOFF_SECONDS = 30
+
+redis_client = (
+    redis.from_url(
+        REDIS_URL,
+        socket_timeout=REDIS_TIMEOUT_SECONDS,
+        socket_connect_timeout=REDIS_TIMEOUT_SECONDS,
+        retry=Retry(NoBackoff(), 0),
     )
+    if REDIS_URL
+    else None
+)
+redis_down_until = 0.0
+
+
+def redis_available() -> bool:
+    return redis_client is not None and time.monotonic() >= redis_down_until
+
+
+def mark_redis_down() -> None:
+    global redis_down_until
+    redis_down_until = time.monotonic() + REDIS_BACKOFF_SECONDS
+
+
+# Model ya prompt (system prompt / format suffix) badle to purane answers,
+# jo Redis me 24h tak pade rehte hain, naye deploy pe hit na ho
+PROMPT_FINGERPRINTS = {
+    variant: hashlib.blake2b(
+        "\x1f".join((GEMINI_MODEL, system_prompt, make_markdown_prompt(""))).encode(),
+        digest_size=8,
+    ).hexdigest()
+    for variant, system_prompt in SYSTEM_PROMPTS.items()
+}
+
+
+def cache_key(question: str, level: str, style: str, language: str) -> bytes:
+    fingerprint = PROMPT_FINGERPRINTS[(level, style, language)]
+    raw = "\x1f".join((fingerprint, question, level, style, language))
+    return hashlib.blake2b(raw.encode(), digest_size=16).digest()
+
+
+async def get_cached_answer(key: bytes) -> str | None:
+    text = answer_cache.get(key)
+    if text is not None or not redis_available():
+        return text
+
+    try:
+        raw = await redis_client.get(CACHE_PREFIX + key)
+    except Exception:
+        logger.exception("Redis error in cache get")
+        mark_redis_down()
+        return None
+
+    if raw is None:
+        return None
+    text = raw.decode()
+    answer_cache[key] = text
+    return text
+
+
+async def set_cached_answer(key: bytes, text: str) -> None:
+    answer_cache[key] = text
+    if not redis_available():
+        return
+
+    try:
+        await redis_client.set(CACHE_PREFIX + key, text, ex=CACHE_TTL_SECONDS)
+    except Exception:
+        logger.exception("Redis error in cache set")
+        mark_redis_down()
+
+
+# ---------------------------------------------------------
+# GEMINI CONCURRENCY LIMIT (AIMD + bounded wait queue)
+# ---------------------------------------------------------
+
+
+class GeminiLimiter:
+    # 429 aaye to limit 0.7x, har successful call pe dheere dheere wapas
+    # max tak. Queue full ho to turant 503, warna Gemini pe 429 storm.
+
+    def __init__(self, max_limit: int, queue_limit: int):
+        self.max_limit = max_limit
+        self.queue_limit = queue_limit
+        self.limit = float(max_limit)
+        self.inflight = 0
+        self.waiting = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        async with self._cond:
+            if self.inflight >= int(self.limit) and self.waiting >= self.queue_limit:
+                raise HTTPException(
+                    status_code=503,
+                    detail="Server busy hai, thodi der baad try karo.",
+                    headers={"Retry-After": str(GEMINI_RETRY_AFTER_SECONDS)},
+                )
+
+            self.waiting += 1
+            try:
+                await self._cond.wait_for(lambda: self.inflight < int(self.limit))
+            finally:
+                self.waiting -= 1
+            self.inflight += 1
+
+    async def release(
+        self, exc: BaseException | None = None, success: bool = False
+    ) -> None:
+        # Sirf poora hua call hi success hai; cancel/disconnect neutral hai
+        async with self._cond:
+            self.inflight -= 1
+            if isinstance(exc, ResourceExhausted):
+                self.limit = max(1.0, self.limit * 0.7)
+            elif success:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.release(exc, success=exc_type is None)
+        return False
+
+
+gemini_limiter = GeminiLimiter(GEMINI_MAX_INFLIGHT, GEMINI_QUEUE_LIMIT)
+
+
+# ---------------------------------------------------------
+# IN-FLIGHT DEDUP (same question at the same time -> one Gemini call)
+# ---------------------------------------------------------
+
+inflight_answers: dict[bytes, asyncio.Task] = {}
+
+
+async def generate_answer(key: bytes, model, prompt: str) -> str:
+    async with gemini_limiter:
+        result = await model.generate_content_async(prompt)
+    text = (result.text or "").strip()
+    if text:
+        await set_cached_answer(key, text)
+    return text
+
+
+def _inflight_done(key: bytes, task: asyncio.Task) -> None:
+    inflight_answers.pop(key, None)
+    if not task.cancelled():
+        # Sab waiters chale gaye ho tab bhi exception "retrieved" mark karo
+        task.exception()
+
+
+async def coalesced_answer(key: bytes, model, prompt: str) -> str:
+    task = inflight_answers.get(key)
+    if task is None:
+        task = asyncio.create_task(generate_answer(key, model, prompt))
+        inflight_answers[key] = task
+        task.add_done_callback(lambda t: _inflight_done(key, t))
+    # shield: ek client disconnect ho to baaki waiters ka call cancel na ho
+    return await asyncio.shield(task)
 
 
 # ---------------------------------------------------------
@@ -154,45 +530,146 @@ async def health():
 
 
 @app.post("/ask-text", response_model=AnswerResponse)
-async def ask_text(payload: AskTextRequest):
-    system_prompt = build_system_prompt(
-        payload.level, payload.style, payload.language
-    )
-    full_prompt = make_markdown_prompt(system_prompt, payload.question.strip())
+async def ask_text(payload: AskTextRequest, request: Request):
+    question = payload.question
+    key = cache_key(question, payload.level, payload.style, payload.language)
+    cached = await get_cached_answer(key)
+    if cached is not None:
+        return AnswerResponse(answer_text=cached)
+
+    models = request.app.state.models
+    model = models[(payload.level, payload.style, payload.language)]
+    full_prompt = make_markdown_prompt(question)
 
     try:
-        result = model.generate_content(full_prompt)
-        text = (result.text or "").strip()
-    except Exception as e:
-        print("Gemini error in /ask-text:", repr(e))
+        text = await coalesced_answer(key, model, full_prompt)
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Gemini error in /ask-text")
         text = "Sorry, backend me kuch error aa gaya. Please try again."
 
     return AnswerResponse(answer_text=text)
 
 
+def sse_event(data: dict) -> str:
+    return f"data: {orjson.dumps(data).decode()}\n\n"
+
+
+@app.post("/ask-text/stream")
+async def ask_text_stream(payload: AskTextRequest, request: Request):
+    question = payload.question
+    key = cache_key(question, payload.level, payload.style, payload.language)
+    cached = await get_cached_answer(key)
+
+    if cached is not None:
+
+        async def cached_events():
+            yield sse_event({"delta": cached})
+            yield sse_event({"done": True})
+
+        return StreamingResponse(cached_events(), media_type="text/event-stream")
+
+    models = request.app.state.models
+    model = models[(payload.level, payload.style, payload.language)]
+    full_prompt = make_markdown_prompt(question)
+
+    # Slot response shuru hone se pehle lo, taaki overload pe asli
+    # 503 + Retry-After jaaye. Stream khatam hone tak slot pakad ke rakho.
+    await gemini_limiter.acquire()
+    released = False
+
+    async def release_slot(exc: BaseException | None = None, success: bool = False):
+        nonlocal released
+        if not released:
+            released = True
+            await gemini_limiter.release(exc, success=success)
+
+    async def events():
+        parts = []
+        error = None
+        completed = False
+
+        try:
+            response = await model.generate_content_async(full_prompt, stream=True)
+            async for chunk in response:
+                # Client chala gaya to Gemini stream yahin chhod do
+                if await request.is_disconnected():
+                    return
+                parts.append(chunk.text)
+                yield sse_event({"delta": chunk.text})
+            completed = True
+        except Exception as e:
+            error = e
+            logger.exception("Gemini error in /ask-text/stream")
+        finally:
+            await release_slot(error, success=completed)
+
+        if error is not None:
+            yield sse_event(
+                {"error": "Sorry, backend me kuch error aa gaya. Please try again."}
+            )
+            return
+
+        text = "".join(parts).strip()
+        if text:
+            await set_cached_answer(key, text)
+        yield sse_event({"done": True})
+
+    # Agar generator kabhi start hi na ho (client pehle hi chala gaya),
+    # to background task slot chhod deta hai; release_slot idempotent hai.
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        background=BackgroundTask(release_slot),
+    )
+
+
 @app.post("/ask-image", response_model=AnswerResponse)
 async def ask_image(
+    request: Request,
     file: UploadFile = File(...),
     level: Level = "basic",
     style: Style = "detailed",
     language: Language = "hinglish",
 ):
-    system_prompt = build_system_prompt(level, style, language)
+    model = request.app.state.models[(level, style, language)]
 
     try:
         img_bytes = await file.read()
+        image_part = await prepare_image_part(
+            request.app.state.image_pool, img_bytes, file.content_type
+        )
 
         contents = [
-            system_prompt
-            + "\nRewrite the question clearly from the image. Then solve step-by-step.\n",
-            {"mime_type": file.content_type or "image/jpeg", "data": img_bytes},
+            "Rewrite the question clearly from the image. Then solve step-by-step.\n",
+            image_part,
         ]
 
-        result = model.generate_content(contents)
+        async with gemini_limiter:
+            result = await model.generate_content_async(contents)
         text = (result.text or "").strip()
 
-    except Exception as e:
-        print("Gemini error in /ask-image:", repr(e))
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Gemini error in /ask-image")
         text = "Sorry, image se question read karte waqt error aa gaya."
 
     return AnswerResponse(answer_text=text)
+
+
+# Launch: `python main.py` (ab yahi supported command hai). Plain
+# `uvicorn main:app` ye block skip karta hai aur single worker pe chalta hai.
+if __name__ == "__main__":
+    # "auto": uvloop/httptools installed ho (`uvicorn[standard]`, Linux/macOS)
+    # to wahi use hote hain; Windows pe uvloop nahi hota, wahan asyncio
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8080")),
+        workers=int(os.getenv("WEB_CONCURRENCY", "4")),
+        loop="auto",
+        http="auto",
+        timeout_keep_alive=75,
+    )